@@ -14,8 +14,6 @@ from pathlib import Path
 import environ
 import os
 
-import boto3
-
 # Initialise environment variables
 env = environ.Env(
     # set casting, default value
@@ -27,7 +25,8 @@ env = environ.Env(
     ECS_INSTANCE_LAUNCH_TEMPLATE=(str, "defaultECS"),
     SERVER_TASK_DEFINITION=(str, 'LaunchGameserver'),
     BACKUP_GAMESERVER=(str, "127.0.0.1:8888"),
-    THREAD_SLEEP_TIME=(int, 60)
+    THREAD_SLEEP_TIME=(int, 60),
+    TASK_EVENTS_QUEUE_URL=(str, "")
 )
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -161,7 +160,7 @@ assert (DOWNSCALE_MARGIN - UPSCALE_MARGIN) > SERVER_CAPACITY
 
 # AWS Configurations
 AWS_REGION = env('AWS_REGION')
-ECS_CLIENT = boto3.client("ecs", region_name = AWS_REGION)
-EC2_CLIENT = boto3.client("ec2", region_name = AWS_REGION)
 ECS_INSTANCE_LAUNCH_TEMPLATE = env('ECS_INSTANCE_LAUNCH_TEMPLATE')
 SERVER_TASK_DEFINITION = env('SERVER_TASK_DEFINITION')
+# SQS queue receiving 'ECS Task State Change' events from EventBridge; leave empty to poll ECS instead
+TASK_EVENTS_QUEUE_URL = env('TASK_EVENTS_QUEUE_URL')
@@ -2,12 +2,92 @@
 This module has functions to perform certain AWS operations (required by our app) using boto3
 Note: There is no exception handling done by the module functions. Exceptions must be handled by the calling functions.
 """
+import json
+from collections import OrderedDict
+from functools import lru_cache
+from threading import Lock
+import boto3
+from botocore.config import Config
 from django.conf import settings
 
-# uncomment if running this separately (probably if MAIN)
-# ecs_client = boto3.client("ecs", region_name = "ap-south-1")
-# ec2_client = boto3.client("ec2", region_name = "ap-south-1")
-# ec2_launch_template = 'defaultECS'
+# max number of ids accepted by a single ECS/EC2 describe call
+DESCRIBE_BATCH_SIZE = 100
+
+# max number of ids accepted by a single EC2 terminate call
+TERMINATE_BATCH_SIZE = 1000
+
+# max number of public IP addresses of EC2 instances cached by get_ip and get_ips
+IP_CACHE_SIZE = 4096
+
+# time (in seconds) for which a receive call waits for messages to arrive in SQS queue (long polling)
+SQS_WAIT_TIME = 20
+
+# timeouts (in seconds) for AWS api calls, so that a stuck call fails fast and is retried; adaptive retries also back off when throttled
+# clients are shared by the health check, listener and manager threads, so the connection pool is larger than the default of 10
+AWS_CLIENT_CONFIG = Config(
+    connect_timeout=1,
+    read_timeout=5,
+    retries={'max_attempts': 10, 'mode': 'adaptive'},
+    max_pool_connections=64
+)
+# long polling keeps the receive call waiting for SQS_WAIT_TIME seconds
+SQS_CLIENT_CONFIG = AWS_CLIENT_CONFIG.merge(Config(read_timeout=SQS_WAIT_TIME + 5))
+# ECS RunTask isn't idempotent (no client token is sent), so retrying it after a timeout could start duplicate tasks
+# hence launch calls get a generous read timeout and are never retried
+ECS_LAUNCH_CLIENT_CONFIG = AWS_CLIENT_CONFIG.merge(Config(
+    read_timeout=60,
+    retries={'max_attempts': 0, 'mode': 'standard'}
+))
+
+# boto3 clients are created lazily (on first use) and then shared by all threads, as creating them is slow
+# region is passed explicitly so that boto3 doesn't look it up from the EC2 instance metadata service
+_clients: dict = {}
+_clients_lock = Lock() # creating clients from the default boto3 session isn't thread safe
+
+def _get_client(service_name: str, config: Config = AWS_CLIENT_CONFIG, client_name: str = None):
+    """Returns the shared client (identified by client_name, which defaults to service_name) for the specified AWS service, creating it if needed"""
+    client_name = client_name or service_name
+    with _clients_lock:
+        if client_name not in _clients:
+            _clients[client_name] = boto3.client(service_name, region_name=settings.AWS_REGION, config=config)
+        return _clients[client_name]
+
+def get_ecs_client():
+    """Returns the shared ECS client"""
+    return _get_client("ecs")
+
+def get_ecs_launch_client():
+    """Returns the shared ECS client for launching tasks, which doesn't retry calls"""
+    return _get_client("ecs", ECS_LAUNCH_CLIENT_CONFIG, "ecs-launch")
+
+def get_ec2_client():
+    """Returns the shared EC2 client"""
+    return _get_client("ec2")
+
+def get_sqs_client():
+    """Returns the shared SQS client"""
+    return _get_client("sqs", SQS_CLIENT_CONFIG)
+
+# public IP addresses of EC2 instances (by ec2 id) as fetched by get_ip and get_ips, least recently used first
+_ip_cache: OrderedDict = OrderedDict()
+_ip_cache_lock = Lock() # the cache is used by the launch, listener, terminate and bootstrap threads
+
+def _get_cached_ip(ec2_id: str) -> str:
+    """Returns the cached public IP address of the EC2 instance, or None if it isn't cached"""
+    with _ip_cache_lock:
+        ip = _ip_cache.get(ec2_id)
+        if ip is not None:
+            _ip_cache.move_to_end(ec2_id)
+        return ip
+
+def _cache_ips(ips: dict) -> None:
+    """Caches the specified public IP addresses (by ec2 id), evicting the least recently used ones beyond IP_CACHE_SIZE"""
+    with _ip_cache_lock:
+        for ec2_id, ip in ips.items():
+            _ip_cache[ec2_id] = ip
+            _ip_cache.move_to_end(ec2_id)
+        while len(_ip_cache) > IP_CACHE_SIZE:
+            _ip_cache.popitem(last=False)
 
 # all these functions throw exceptions if something is off and don't handle any unexpected paramters or api responses
 
@@ -22,6 +102,33 @@ def running_task_waiter(task_arn: str, ecs_client) -> None:
         ]
     )
 
+def receive_task_state_changes(queue_url: str, sqs_client) -> list:
+    """
+    Long polls the specified SQS queue for 'ECS Task State Change' (and 'EC2 Instance State-change Notification') events (delivered by EventBridge rules) and returns the list of event details
+    Messages which parse are deleted from the queue; the ones which don't are logged and left in the queue (to be moved to a dead-letter queue, if configured)
+    """
+    messages = sqs_client.receive_message(
+        QueueUrl=queue_url,
+        MaxNumberOfMessages=10,
+        WaitTimeSeconds=SQS_WAIT_TIME
+    ).get('Messages', [])
+
+    details: list = []
+    parsed_messages: list = []
+    for m in messages:
+        try:
+            details.append(json.loads(m['Body'])['detail'])
+            parsed_messages.append(m)
+        except Exception as e:
+            print("Skipping unexpected message in task events queue:", m.get('MessageId'), e)
+
+    if len(parsed_messages) > 0:
+        sqs_client.delete_message_batch(
+            QueueUrl=queue_url,
+            Entries=[{'Id': str(i), 'ReceiptHandle': m['ReceiptHandle']} for i, m in enumerate(parsed_messages)]
+        )
+    return details
+
 def get_task_description(task_arn: str, ecs_client) -> dict:
     """Returns description of the specified task"""
     task_description = ecs_client.describe_tasks(
@@ -32,6 +139,16 @@ def get_task_description(task_arn: str, ecs_client) -> dict:
     )['tasks'][0]
     return task_description
 
+def get_task_descriptions(task_arns: list, ecs_client) -> list:
+    """Returns descriptions of all the specified tasks, using as few api calls as possible"""
+    task_descriptions: list = []
+    for i in range(0, len(task_arns), DESCRIBE_BATCH_SIZE):
+        task_descriptions += ecs_client.describe_tasks(
+            # DEFAULT_CLUSTER
+            tasks=task_arns[i:i + DESCRIBE_BATCH_SIZE]
+        )['tasks']
+    return task_descriptions
+
 def get_exposed_port(task_description: dict) -> str:
     """Extracts and returns the port exposed from task description of a running task"""
     network_binding = task_description['containers'][0]['networkBindings'][0]
@@ -41,6 +158,14 @@ def get_exposed_port(task_description: dict) -> str:
 def get_ec2_id(task_description: dict, ecs_client) -> str:
     """Returns ec2 id of the instance on which task is running"""
     container_instance_arn = task_description['containerInstanceArn']
+    return get_container_instance_ec2_id(container_instance_arn, ecs_client)
+
+@lru_cache(maxsize=1024)
+def get_container_instance_ec2_id(container_instance_arn: str, ecs_client) -> str:
+    """
+    Returns ec2 id of the specified container instance
+    The mapping doesn't change for the lifetime of a container instance, so results are cached
+    """
     container_description = ecs_client.describe_container_instances(
         # DEFAULT_CLUSTER
         containerInstances=[
@@ -50,19 +175,65 @@ def get_ec2_id(task_description: dict, ecs_client) -> str:
     ec2_id: str = container_description['ec2InstanceId'] # Extract ec2 id 
     return ec2_id
 
+def get_ec2_ids(container_instance_arns: list, ecs_client) -> dict:
+    """Returns a dict mapping each of the specified container instance arns to its ec2 id, using as few api calls as possible"""
+    ec2_ids: dict = {}
+    for i in range(0, len(container_instance_arns), DESCRIBE_BATCH_SIZE):
+        container_descriptions = ecs_client.describe_container_instances(
+            # DEFAULT_CLUSTER
+            containerInstances=container_instance_arns[i:i + DESCRIBE_BATCH_SIZE]
+        )['containerInstances']
+        for container_description in container_descriptions:
+            ec2_ids[container_description['containerInstanceArn']] = container_description['ec2InstanceId']
+    return ec2_ids
+
 def get_ip(ec2_id: str, ec2_client) -> str:
-    """Returns the Public IP address of the EC2 instance"""
-    ec2_instance_description = ec2_client.describe_instances(
-        InstanceIds=[
-            ec2_id,
-        ]
-    )['Reservations'][0]['Instances'][0]
-    ip: str = str(ec2_instance_description['PublicIpAddress'])
+    """
+    Returns the Public IP address of the EC2 instance
+    The public IP of an instance only changes on stop/start, so results are cached till forget_ip is called for the instance
+    """
+    ip = _get_cached_ip(ec2_id)
+    if ip is None:
+        ec2_instance_description = ec2_client.describe_instances(
+            InstanceIds=[
+                ec2_id,
+            ]
+        )['Reservations'][0]['Instances'][0]
+        ip = str(ec2_instance_description['PublicIpAddress'])
+        _cache_ips({ec2_id: ip})
     return ip
+
+def get_ips(ec2_ids: list, ec2_client) -> dict:
+    """
+    Returns a dict mapping each of the specified EC2 instance ids to its public IP address, using as few api calls as possible
+    Like get_ip, results are cached and only the instances missing from the cache are described
+    """
+    ips: dict = {}
+    uncached_ec2_ids: list = []
+    for ec2_id in ec2_ids:
+        ip = _get_cached_ip(ec2_id)
+        if ip is None:
+            uncached_ec2_ids.append(ec2_id)
+        else:
+            ips[ec2_id] = ip
+    for i in range(0, len(uncached_ec2_ids), DESCRIBE_BATCH_SIZE):
+        reservations = ec2_client.describe_instances(
+            InstanceIds=uncached_ec2_ids[i:i + DESCRIBE_BATCH_SIZE]
+        )['Reservations']
+        for reservation in reservations:
+            for ec2_instance_description in reservation['Instances']:
+                ips[ec2_instance_description['InstanceId']] = str(ec2_instance_description['PublicIpAddress'])
+    _cache_ips({ec2_id: ips[ec2_id] for ec2_id in uncached_ec2_ids if ec2_id in ips})
+    return ips
+
+def forget_ip(ec2_id: str) -> None:
+    """Removes the cached public IP address of the EC2 instance, to be called when the instance is stopped or terminated"""
+    with _ip_cache_lock:
+        _ip_cache.pop(ec2_id, None)
     
 def launch_task(task_definition: str) -> str:
     """Inititates a task in a distinct ECS instance and returns the task arn"""
-    ecs_client = settings.ECS_CLIENT
+    ecs_client = get_ecs_launch_client()
     response = ecs_client.run_task(
         taskDefinition=task_definition,
         launchType='EC2',
@@ -79,7 +250,7 @@ def launch_task(task_definition: str) -> str:
 
 def get_tasks(task_family: str) -> list:
     """Returns the list of tasks (arns) of the specified family with desired status = RUNNING"""
-    ecs_client = settings.ECS_CLIENT
+    ecs_client = get_ecs_client()
     task_arns = ecs_client.list_tasks(
         # DEFAULT_CLUSTER
         family=task_family,
@@ -89,7 +260,7 @@ def get_tasks(task_family: str) -> list:
 
 def stop_task(task_arn: str, reason_to_stop: str = "Not specified"):
     """Stops the given task"""
-    ecs_client = settings.ECS_CLIENT
+    ecs_client = get_ecs_client()
     response = ecs_client.stop_task(
         # DEFAULT_CLUSTER
         task=task_arn,
@@ -99,7 +270,7 @@ def stop_task(task_arn: str, reason_to_stop: str = "Not specified"):
 def launch_ecs_instance() -> None:
     """Launches an ECS instance and waits for its status to be OK"""
     # DEFAULT_CLUSTER: Refer to user data section of https://docs.aws.amazon.com/AmazonECS/latest/developerguide/launch_container_instance.html#linux-liw-advanced-details for additional steps required to use a different cluster
-    ec2_client = settings.EC2_CLIENT
+    ec2_client = get_ec2_client()
     response = ec2_client.run_instances(
         MaxCount=1,
         MinCount=1,
@@ -115,8 +286,20 @@ def launch_ecs_instance() -> None:
 
 def terminate_ec2(id: str) -> None:
     """Terminates the specified EC2 instance"""
-    ec2_client = settings.EC2_CLIENT
+    ec2_client = get_ec2_client()
     response = ec2_client.terminate_instances(InstanceIds=[id,])
     # print(response)
+    forget_ip(id)
     print("EC2 instance ", id, " terminated")
     return
+
+def terminate_ec2_instances(ids: list) -> None:
+    """Terminates all the specified EC2 instances, using as few api calls as possible"""
+    ec2_client = get_ec2_client()
+    for i in range(0, len(ids), TERMINATE_BATCH_SIZE):
+        response = ec2_client.terminate_instances(InstanceIds=ids[i:i + TERMINATE_BATCH_SIZE])
+        # print(response)
+    for id in ids:
+        forget_ip(id)
+    print("EC2 instances ", ids, " terminated")
+    return
@@ -1,101 +1,279 @@
 """This module has classes (Server and ServerManager) for management and autoscaling of Gameservers on AWS"""
 
-from time import sleep
+from time import sleep, monotonic
+from dataclasses import dataclass, field
+from typing import Callable, ClassVar
+import json
 from django.conf import settings
 import requests
-from threading import Thread
+from requests.adapters import HTTPAdapter
+from threading import Thread, Event, Lock
+from concurrent.futures import ThreadPoolExecutor
+from itertools import count
+from math import ceil
+import heapq
 from .aws_utils import *
 
+# (connect, read) timeouts in seconds for health check requests, so that one slow server cannot stall the tick
+HEALTH_CHECK_TIMEOUT = (1, 2)
+
+# max time (in seconds) to wait for the RUNNING event of a task before falling back to polling ECS
+TASK_RUNNING_EVENT_TIMEOUT = 120
+
+# shared pool used to run health checks of all the servers in parallel
+health_check_pool = ThreadPoolExecutor(max_workers=32, thread_name_prefix='health-check')
+
+def create_health_check_session() -> requests.Session:
+    """Returns a session which keeps alive and reuses connections to the servers across health checks"""
+    session = requests.Session()
+    session.headers['Accept-Encoding'] = 'identity' # health responses are tiny, so compressing them only costs cpu
+    adapter = HTTPAdapter(pool_connections=64, pool_maxsize=64, max_retries=0)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+class TaskStateListener(Thread):
+    """
+    Thread which drains 'ECS Task State Change' events from the SQS queue (settings.TASK_EVENTS_QUEUE_URL) and signals the tasks which transition to RUNNING state.
+    It also drops cached public IPs of EC2 instances on 'EC2 Instance State-change Notification' events, if those are routed to the queue as well.
+    This replaces polling ECS with the tasks_running waiter while a Server waits for its task to start.
+
+    Attributes:
+    * running_events: dict mapping task arn to an Event which is set once the task is RUNNING
+    """
+    # max number of RUNNING events remembered for tasks which nobody is waiting on (yet)
+    MAX_UNCLAIMED_EVENTS = 1024
+
+    def __init__(self):
+        Thread.__init__(self, daemon=True, name="task-state-listener")
+        self.queue_url: str = settings.TASK_EVENTS_QUEUE_URL
+        self.running_events: dict = {}
+        self.lock = Lock()
+
+    def _get_event(self, task_arn: str) -> Event:
+        """Returns the Event for the specified task, creating it if needed"""
+        with self.lock:
+            event = self.running_events.get(task_arn)
+            if event is None:
+                event = Event()
+                self.running_events[task_arn] = event
+                if len(self.running_events) > self.MAX_UNCLAIMED_EVENTS:
+                    # forget the oldest event which is already set; events which aren't set yet have a wait_until_running caller blocked on them
+                    for arn, e in self.running_events.items():
+                        if e.is_set():
+                            del self.running_events[arn]
+                            break
+            return event
+
+    def wait_until_running(self, task_arn: str, timeout: float) -> bool:
+        """
+        Blocks till the specified task is RUNNING or the timeout expires
+        Returns True if the task is RUNNING and False otherwise
+        """
+        is_running = self._get_event(task_arn).wait(timeout)
+        with self.lock:
+            self.running_events.pop(task_arn, None)
+        return is_running
+
+    def receive_events(self) -> None:
+        """Receives a batch of events from the queue (waiting for them to arrive) and handles them"""
+        for detail in receive_task_state_changes(self.queue_url, get_sqs_client()):
+            try:
+                if detail.get('state') in ('stopping', 'stopped', 'shutting-down', 'terminated'):
+                    # the public IP of the EC2 instance changes if it is started again
+                    forget_ip(detail['instance-id'])
+                elif detail.get('lastStatus') == 'RUNNING':
+                    self._get_event(detail['taskArn']).set()
+            except Exception as e:
+                # a malformed event must not stop the listener
+                print("Skipping unexpected task event:", detail, e)
+
+    def run(self):
+        print("Starting task state listener thread")
+
+        while(True):
+            try:
+                self.receive_events()
+            except Exception as e:
+                print(e)
+                sleep(1)
+
+task_state_listener = TaskStateListener()
+
+@dataclass(slots=True, eq=False)
 class Server():
     """
     Wrapper class to store relevant info about a RUNNING ECS server instance
+    Use Server.create (or Server.from_descriptions) to construct a Server from the AWS task
 
     Attributes:
     * task_arn: string storing aws task arn of the server instance
+    * ec2_id: string storing id of the EC2 instance on which the server instance is running
     * address: string storing socket address of the server instance
-    * status: string from {'RUNNING', 'PENDING', 'STOPPED'}
     * available_capacity: integer measure of capacity of the server instance to handle future connections; note that this is weakly consistent and not real time
     * ready_to_close: boolean flag specifying whether the server instance can be terminated
+    * status: string from {'RUNNING', 'PENDING', 'STOPPED'}
+    * health_url: string storing url of the health api of the server instance (derived from address)
+    * lock: Lock guarding available_capacity and ready_to_close, which are updated by health checks as well as server assignments
     """
+    task_arn: str
+    ec2_id: str
+    address: str
+    available_capacity: int = 0
+    ready_to_close: bool = False
+    status: str = 'RUNNING'
+    health_url: str = field(init=False, repr=False)
+    lock: Lock = field(default_factory=Lock, init=False, repr=False)
 
-    def __init__(self, task_arn: str):
-        """Waits for the task to transition to RUNNING state and then retrieves and stores relevant details about it."""
-        self.task_arn: str = task_arn
-        running_task_waiter(task_arn, settings.ECS_CLIENT)
-        self.status: str = 'RUNNING'
+    # http session shared by all the servers for health checks
+    _session: ClassVar[requests.Session] = create_health_check_session()
+
+    def __post_init__(self):
+        # the address never changes, so build the url once instead of on every health check
+        self.health_url = "http://" + self.address + "/health/"
+
+    @classmethod
+    def create(cls, task_arn: str):
+        """Waits for the task to transition to RUNNING state and then retrieves relevant details about it to create a Server"""
+        if not (task_state_listener.is_alive() and task_state_listener.wait_until_running(task_arn, TASK_RUNNING_EVENT_TIMEOUT)):
+            # no event received, so poll ECS instead
+            running_task_waiter(task_arn, get_ecs_client())
         
-        task_description = get_task_description(task_arn, settings.ECS_CLIENT)
+        task_description = get_task_description(task_arn, get_ecs_client())
 
-        self.ec2_id: str = get_ec2_id(task_description, settings.ECS_CLIENT)
+        ec2_id: str = get_ec2_id(task_description, get_ecs_client())
+        ip: str = get_ip(ec2_id, get_ec2_client())
+        return cls.from_descriptions(task_description, ec2_id, ip)
 
+    @classmethod
+    def from_descriptions(cls, task_description: dict, ec2_id: str, ip: str):
+        """Creates a Server from already fetched details of a RUNNING task, without making any api calls"""
         port: str = get_exposed_port(task_description)
-        ip: str = get_ip(self.ec2_id, settings.EC2_CLIENT)
-        self.address: str = ip + ":" + port
-
-        self.available_capacity: int = 0
-        self.ready_to_close: bool = False
-        # self.update_state()
+        return cls(task_arn=task_description['taskArn'], ec2_id=ec2_id, address=ip + ":" + port)
         
-    def update_state(self) -> bool:
+    def update_state(self, on_capacity_raised: Callable[[], None] = None) -> bool:
         """
         Makes api requests to update available capacity and ready to close flag.
         Note that the api call may fail even after the task is running condition as it takes sometime for django to setup
+        on_capacity_raised (if specified) is called when the update raises the available capacity
         Returns True if the api call is successful and False otherwise.
         """
-        url = "http://"+self.address+"/health/"
         try: 
-            state_json: dict = requests.get(url).json()
-            self.ready_to_close = state_json['ready_to_close']
-            self.available_capacity = state_json['available_capacity']
-            return True
+            response = self._session.get(self.health_url, timeout=HEALTH_CHECK_TIMEOUT)
+            state_json: dict = json.loads(response.content) # parse the raw bytes, skipping decoding into text
+            with self.lock:
+                capacity_raised: bool = state_json['available_capacity'] > self.available_capacity
+                self.ready_to_close = state_json['ready_to_close']
+                self.available_capacity = state_json['available_capacity']
         except Exception as e:
             print(e)
             return False
 
+        if capacity_raised and on_capacity_raised is not None:
+            on_capacity_raised() # called after releasing the lock, as it may take other locks
+        return True
+
+    def reserve_capacity(self) -> bool:
+        """
+        Atomically decrements available capacity if the server instance has any
+        Returns True if capacity was reserved and False otherwise
+        """
+        with self.lock:
+            if self.available_capacity <= 0:
+                return False
+            self.available_capacity -= 1
+            return True
+
+def bulk_bootstrap_servers(task_arns: list) -> list:
+    """
+    Returns Server objects for all the specified tasks
+    Details of all the tasks are fetched with batched api calls instead of a few calls per task. Tasks which are not RUNNING yet are waited upon individually.
+    """
+    task_descriptions: list = get_task_descriptions(task_arns, get_ecs_client())
+    running_task_descriptions: list = [t for t in task_descriptions if t['lastStatus'] == 'RUNNING']
+    pending_task_arns: list = [t['taskArn'] for t in task_descriptions if t['lastStatus'] != 'RUNNING']
+
+    ec2_ids: dict = get_ec2_ids(list({t['containerInstanceArn'] for t in running_task_descriptions}), get_ecs_client())
+    ips: dict = get_ips(list(set(ec2_ids.values())), get_ec2_client())
+
+    servers: list = []
+    for task_description in running_task_descriptions:
+        ec2_id: str = ec2_ids[task_description['containerInstanceArn']]
+        servers.append(Server.from_descriptions(task_description, ec2_id, ips[ec2_id]))
+
+    servers += [Server.create(arn) for arn in pending_task_arns]
+    return servers
+
 class ServerManagerThread(Thread):
     """
     ServerManagerThread is subclass of thread. The thread routinely updates the state of each server instance and based on this information, it upscales/downscales server instances. (Check README and code for implementation details)
     
     Attributes:
-    * available_servers: list of servers available for connection
-    * standby_servers: list of servers kept in standby as part of downscaling; they will be terminated when the 'ready_to_close' flag is True.
-    * total_available_capacity: integer sum of available capacity of all servers
-    * upscale_margin: min extra capacity maintained; one server instance is provisioned if total_available_capacity < upscale_margin
+    * available_servers: dict mapping task arn to server, for servers available for connection
+    * capacity_heap: max-heap (by available capacity) of the available servers, stored as a heapq of [-available_capacity, counter, server] entries; removed servers are lazily deleted by setting server to None in their entry
+    * heap_entries: dict mapping task arn of each available server to its entry in capacity_heap
+    * capacity_heap_stale: boolean flag set when a health check raises the capacity of a server after the heap was built, leaving its entry lower than its capacity
+    * servers_lock: Lock guarding the available servers, the heap and total_available_capacity; each server assignment updates the heap, so assignments take it exclusively as well
+    * standby_servers: dict mapping task arn to server, for servers kept in standby as part of downscaling; they will be terminated when the 'ready_to_close' flag is True.
+    * total_available_capacity: integer sum of available capacity of all available servers; recomputed in each routine update and decremented on each server assignment
+    * upscale_margin: min extra capacity maintained; standby servers are moved back and new server instances are provisioned to cover the deficit if total_available_capacity < upscale_margin
     * downscale_margin: max extra capacity maintained, one server instance is deprovisioned if total_available_capacity > downscale_margin
+    * server_capacity: expected available capacity of a newly launched server instance
     * thread_sleep_time: time interval (in seconds) before the thread carries out routine updates
+    * wake_event: Event which wakes up the thread before thread_sleep_time elapses; set when total_available_capacity drops below upscale_margin or when a newly launched server is added
+    * launch_pool: ThreadPoolExecutor which launches servers off the management thread; each launch occupies a worker for minutes
+    * terminate_pool: ThreadPoolExecutor dedicated to terminating removed servers off the management thread, so terminations never wait behind launches
+    * pending_launches: number of servers being launched in launch_pool, including launched servers which haven't passed a health check yet (their capacity isn't known till then)
+    * unchecked_servers: set of task arns of launched servers which haven't passed a health check yet; guarded by pending_launches_lock
+    * terminate_queue: list of ec2 ids of removed servers, which are terminated in a batch at the end of each routine update
+    * terminate_lock: Lock guarding terminate_queue
+    * unresponsive_since: dict mapping task arn of each server failing health checks to the time (time.monotonic) since when it is failing
+    * startup_grace_time: time (in seconds) for which a launched server which hasn't passed a health check yet may fail them before it is removed, as django takes a while to start up inside the container
 
     This is a singleton class, meaning only one instance of Health can be created during the scope of the proram.
     """
     __shared_instance = None
     
     def __init__(self):
-        if self.__shared_instance == None:
-            Thread.__init__(self)
-            ServerManagerThread.__shared_instance = self
-            self.setDaemon(True)
-            
-            self.task_family = settings.SERVER_TASK_DEFINITION
+        if ServerManagerThread.__shared_instance != None:
+            # checked before initializing the thread, so that a partially initialized thread isn't left behind
+            raise Exception("ServerManagerThread is Singleton class!")
 
-            try:
-                task_arns: list = get_tasks(self.task_family)
-                self.available_servers: list = [Server(arn) for arn in task_arns]
-            except Exception as e:
-                print("Unable to get active tasks in the cluster due to the following exception")
-                print(e)
-                self.available_servers: list = []
+        Thread.__init__(self, daemon=True, name="server-manager")
+        ServerManagerThread.__shared_instance = self
+
+        self.task_family = settings.SERVER_TASK_DEFINITION
 
-            self.standby_servers: list = []
+        try:
+            task_arns: list = get_tasks(self.task_family)
+            self.available_servers: dict = {s.task_arn: s for s in bulk_bootstrap_servers(task_arns)}
+        except Exception as e:
+            print("Unable to get active tasks in the cluster due to the following exception")
+            print(e)
+            self.available_servers: dict = {}
 
-            self.total_available_capacity: int = 0
-            for s in self.available_servers:
-                self.total_available_capacity += s.available_capacity
+        self.standby_servers: dict = {}
 
-            self.upscale_margin: int = settings.UPSCALE_MARGIN
-            self.downscale_margin: int = settings.DOWNSCALE_MARGIN
-            self.thread_sleep_time: int = settings.THREAD_SLEEP_TIME
-        
-        else:
-            raise Exception("ServerManagerThread is Singleton class!")
+        self.servers_lock = Lock()
+        self.heap_counter = count() # tie breaker for servers with equal capacity in the heap
+        self.rebuild_capacity_heap()
+
+        self.total_available_capacity: int = sum(s.available_capacity for s in self.available_servers.values())
+
+        self.upscale_margin: int = settings.UPSCALE_MARGIN
+        self.downscale_margin: int = settings.DOWNSCALE_MARGIN
+        self.server_capacity: int = settings.SERVER_CAPACITY
+        self.thread_sleep_time: int = settings.THREAD_SLEEP_TIME
+        self.wake_event = Event()
+        self.unresponsive_since: dict = {}
+        self.startup_grace_time: int = 2 * self.thread_sleep_time
+        self.launch_pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix='aws-launch')
+        self.terminate_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix='aws-terminate')
+        self.pending_launches: int = 0
+        self.unchecked_servers: set = set()
+        self.pending_launches_lock = Lock()
+        self.terminate_queue: list = []
+        self.terminate_lock = Lock()
     
     @staticmethod
     def get_instance():
@@ -113,112 +291,285 @@ class ServerManagerThread(Thread):
         try:
             launch_ecs_instance()
             task = launch_task(self.task_family)
-            self.available_servers.append(Server(task))
+            server = Server.create(task)
+            with self.pending_launches_lock:
+                # the launch stays pending till the server passes a health check
+                self.unchecked_servers.add(server.task_arn)
+            with self.servers_lock:
+                self.add_available_server(server)
+            self.wake_event.set() # health check the new server right away instead of after thread_sleep_time
             return True
         except Exception as e:
             print(e)
             return False
+
+    def launch_server(self) -> None:
+        """Adds a new server instance in the background (using launch_pool)"""
+        with self.pending_launches_lock:
+            self.pending_launches += 1
+        self.launch_pool.submit(self._launch_server)
+
+    def _launch_server(self) -> bool:
+        """Adds a new server instance; if that fails, the launch is no longer pending"""
+        launched = False
+        try:
+            launched = self.add_server()
+            return launched
+        finally:
+            if not launched:
+                with self.pending_launches_lock:
+                    self.pending_launches -= 1
+
+    def settle_launch(self, server: Server) -> None:
+        """Stops counting the server as a pending launch, if it was one; called once it passes a health check or is removed"""
+        with self.pending_launches_lock:
+            if server.task_arn in self.unchecked_servers:
+                self.unchecked_servers.remove(server.task_arn)
+                self.pending_launches -= 1
     
     def remove_server(self, redundant_server: Server) -> bool:
         """
-        Attempts to remove the specified server instance terminating the EC2 instance (along with task)
+        Removes the specified server instance by queueing its EC2 instance (along with task) for termination
+        The instance is actually terminated by flush_terminations
+        Returns True
+        """
+        with self.terminate_lock:
+            self.terminate_queue.append(redundant_server.ec2_id)
+        return True
+
+    def flush_terminations(self) -> bool:
+        """
+        Attempts to terminate all the EC2 instances queued by remove_server with batched api calls
+        If a batch fails, its instances are terminated one by one so that one bad id doesn't keep the others running
         Returns True if successful and False otheriwse
         """
+        with self.terminate_lock:
+            ec2_ids: list = self.terminate_queue
+            self.terminate_queue = []
+
+        if len(ec2_ids) == 0:
+            return True
+
         try:
-            terminate_ec2(redundant_server.ec2_id)
+            terminate_ec2_instances(ec2_ids)
             return True
         except Exception as e:
             print(e)
-            return False
+
+        success = True
+        for ec2_id in ec2_ids:
+            try:
+                terminate_ec2(ec2_id)
+            except Exception as e:
+                print(e)
+                success = False
+        return success
     
+    def add_available_server(self, server: Server) -> None:
+        """Adds the server to the available servers; servers_lock must be held"""
+        self.available_servers[server.task_arn] = server
+        self.push_to_capacity_heap(server)
+
+    def remove_available_server(self, server: Server) -> None:
+        """Removes the server from the available servers (if present); servers_lock must be held"""
+        self.available_servers.pop(server.task_arn, None)
+        self.settle_launch(server)
+        entry = self.heap_entries.pop(server.task_arn, None)
+        if entry is not None:
+            entry[2] = None # lazy deletion; the entry is skipped when it reaches the top of the heap
+
+    def push_to_capacity_heap(self, server: Server) -> None:
+        """Adds (or updates) the entry of the server in the capacity heap as per its current available capacity"""
+        old_entry = self.heap_entries.get(server.task_arn)
+        if old_entry is not None:
+            old_entry[2] = None
+        entry = [-server.available_capacity, next(self.heap_counter), server]
+        self.heap_entries[server.task_arn] = entry
+        heapq.heappush(self.capacity_heap, entry)
+
+    def rebuild_capacity_heap(self) -> None:
+        """Rebuilds the capacity heap from scratch as per the current available capacity of the available servers"""
+        self.capacity_heap_stale: bool = False
+        self.heap_entries: dict = {}
+        self.capacity_heap: list = []
+        for server in self.available_servers.values():
+            entry = [-server.available_capacity, next(self.heap_counter), server]
+            self.heap_entries[server.task_arn] = entry
+            self.capacity_heap.append(entry)
+        heapq.heapify(self.capacity_heap)
+
+    def mark_capacity_heap_stale(self) -> None:
+        """Flags the capacity heap for a rebuild, as a health check raised the capacity of a server"""
+        with self.servers_lock:
+            self.capacity_heap_stale = True
+
+    def get_max_available_server(self) -> Server:
+        """Return the available server instance with max available capacity"""
+        while len(self.capacity_heap) > 0 and self.capacity_heap[0][2] is None:
+            heapq.heappop(self.capacity_heap) # discard removed servers
+        if len(self.capacity_heap) == 0:
+            raise Exception("No available server")
+        return self.capacity_heap[0][2]
+
+    def _get_max_available_server_with_current_entry(self) -> Server:
+        """Return the server at the top of the capacity heap, after making sure its entry matches its current available capacity"""
+        server = self.get_max_available_server()
+        while -self.capacity_heap[0][0] != server.available_capacity:
+            # a health check updated the capacity after the entry was pushed, so push it again and retry
+            self.push_to_capacity_heap(server)
+            server = self.get_max_available_server()
+        return server
+
     def get_available_server(self) -> Server:
-        """Return Server object of an available server instance"""
-        max_available_server_index = self.get_available_server_index()
-        self.available_servers[max_available_server_index].available_capacity -= 1
-        return self.available_servers[max_available_server_index]
-    
-    def get_available_server_index(self) -> int:
-        """Return the index (in self.available_servers list) of an available server instance"""
-        max_available_server_index = 0
-
-        for i in range(1, len(self.available_servers)):
-            server = self.available_servers[i]
-            if server.available_capacity > self.available_servers[max_available_server_index].available_capacity:
-                max_available_server_index = i
-        
-        return max_available_server_index
+        """
+        Return Server object of an available server instance (one with max available capacity) and reserves a connection on it
+        Raises an exception if no server instance has available capacity
+        """
+        with self.servers_lock:
+            if self.total_available_capacity <= 0:
+                raise Exception("No available server with free capacity")
+
+            server = self._get_max_available_server_with_current_entry()
+            if not server.reserve_capacity():
+                if not self.capacity_heap_stale:
+                    raise Exception("No available server with free capacity")
+                # health checks raised the capacity of other servers since the heap was built, leaving their entries stale too
+                # so rebuild the heap from the current capacities (once, till a health check raises a capacity again) and retry
+                self.rebuild_capacity_heap()
+                server = self._get_max_available_server_with_current_entry()
+                if not server.reserve_capacity():
+                    # even the server with max capacity is full (or a health check emptied it just now)
+                    raise Exception("No available server with free capacity")
+
+            # server is at the top of the heap, so replace its entry with the updated one
+            entry = [-server.available_capacity, next(self.heap_counter), server]
+            self.heap_entries[server.task_arn] = entry
+            heapq.heapreplace(self.capacity_heap, entry)
+
+            self.total_available_capacity -= 1
+            if self.total_available_capacity == self.upscale_margin - 1:
+                # capacity just dropped below the upscale margin, so don't wait for the next routine update
+                self.wake_event.set()
+            return server
     
     def get_available_servers(self) -> list:
         """Returns the list of available server instances as maintained by the class object"""
-        return self.available_servers
+        with self.servers_lock:
+            return list(self.available_servers.values())
 
-    def run(self):
-        """Main function which carries out routinely maintainance and updates in the backgorund"""
+    def routine_update(self) -> None:
+        """Carries out one routine update: health checks all the servers, and then upscales/downscales and removes servers as required"""
 
-        print("Starting server management thread")
+        now = monotonic()
+        unresponsive_servers: list = [] # maintain a list of servers which don't respond to health checks
 
-        while(True):
+        # servers may be added by launch_pool in the meantime, so work on a snapshot
+        available_servers: list = self.get_available_servers()
+
+        # health checks are network bound, so run them in parallel for all the servers
+        available_results = health_check_pool.map(lambda s: s.update_state(self.mark_capacity_heap_stale), available_servers)
+        standby_results = health_check_pool.map(Server.update_state, self.standby_servers.values())
 
-            new_total_available_capacity = 0 # reset total available capacity
-            unresponsive_servers: list = [] # maintain a list of servers which don't respond to health checks
-            for s in self.available_servers:
-                if not s.update_state():
-                    # server isn't responding to health check
+        for s, responsive in zip(available_servers, available_results):
+            if responsive:
+                self.unresponsive_since.pop(s.task_arn, None)
+                self.settle_launch(s)
+            else:
+                # server isn't responding to health check
+                with s.lock:
                     s.available_capacity = 0
-                    unresponsive_servers.append(s)
-                new_total_available_capacity += s.available_capacity
+                unresponsive_servers.append(s)
 
-            self.total_available_capacity = new_total_available_capacity
-            
-            for s in self.standby_servers:
-                if not s.update_state():
-                    unresponsive_servers.append(s)
-
-            print("state updated")
-            print("Total Available Capacity", end=': ')
-            print(self.total_available_capacity)
-
-            if self.total_available_capacity < self.upscale_margin:
-                print("Upscale")
-
-                if len(self.standby_servers) == 0:
-                    # If there is no server in standby, launch new server instance
-                    self.add_server()
-                else:
-                    # Move a standby server instance back as an available server
-                    s = self.standby_servers.pop(0)
+        with self.servers_lock:
+            # recompute the total from scratch; between routine updates it is maintained incrementally by get_available_server
+            self.total_available_capacity = sum(s.available_capacity for s in self.available_servers.values())
+            self.rebuild_capacity_heap() # capacities have changed, so the heap has to be rebuilt
+        
+        for s, responsive in zip(self.standby_servers.values(), standby_results):
+            if responsive:
+                self.unresponsive_since.pop(s.task_arn, None)
+            else:
+                unresponsive_servers.append(s)
+
+        print("state updated")
+        print("Total Available Capacity", end=': ')
+        print(self.total_available_capacity)
+
+        if self.total_available_capacity < self.upscale_margin:
+            print("Upscale")
+
+            # Move standby server instances back as available servers till the deficit is covered
+            while self.total_available_capacity < self.upscale_margin and len(self.standby_servers) > 0:
+                s = self.standby_servers.pop(next(iter(self.standby_servers))) # oldest standby server
+                with self.servers_lock:
                     self.total_available_capacity += s.available_capacity
-                    self.available_servers.append(s)
-            
-            elif (self.total_available_capacity > self.downscale_margin) & (len(self.available_servers)>1) :
-                    print("Downscale")
+                    self.add_available_server(s)
+
+            # Launch enough new server instances for the remaining deficit
+            # Pending launches (including launched servers whose capacity isn't known yet as they haven't passed a health check) are counted at server_capacity each,
+            # so that a server registered during this routine update, or still starting up, doesn't trigger another launch
+            deficit: int = self.upscale_margin - self.total_available_capacity
+            with self.pending_launches_lock:
+                servers_to_launch: int = max(0, ceil(deficit / self.server_capacity) - self.pending_launches)
+            for _ in range(servers_to_launch):
+                self.launch_server()
+        
+        elif self.total_available_capacity > self.downscale_margin:
+            with self.servers_lock:
+                s = None
+                if len(self.available_servers) > 1:
                     # Move a server instance to standby
-                    s = self.available_servers.pop(self.get_available_server_index())
+                    s = self.get_max_available_server()
+                    self.remove_available_server(s)
                     self.total_available_capacity -= s.available_capacity
-                    self.standby_servers.append(s)
+            if s is not None:
+                print("Downscale")
+                self.standby_servers[s.task_arn] = s
 
-            # Terminate standby servers with are ready to close keep only the remaining ones
-            remaining_standby_servers: list = []
-            for s in self.standby_servers:
-                print("Removing extra servers")
+        # Terminate standby servers with are ready to close keep only the remaining ones
+        remaining_standby_servers: dict = {}
+        for s in self.standby_servers.values():
+            print("Removing extra servers")
+
+            if s.ready_to_close:
+                self.unresponsive_since.pop(s.task_arn, None)
+                self.remove_server(s)
+            else:
+                remaining_standby_servers[s.task_arn] = s
+        
+        self.standby_servers = remaining_standby_servers
+        
+        # Unresponsive servers are given thread_sleep_time seconds to recover (or startup_grace_time seconds to start up, if they haven't passed a health check yet)
+        # If they don't respond to health checks even after that, then remove them
+        for s in unresponsive_servers:
+            with self.pending_launches_lock:
+                grace_time: int = self.startup_grace_time if s.task_arn in self.unchecked_servers else self.thread_sleep_time
+            if now - self.unresponsive_since.setdefault(s.task_arn, now) < grace_time:
+                continue
+            del self.unresponsive_since[s.task_arn]
+            with self.servers_lock:
+                was_available: bool = s.task_arn in self.available_servers
+                self.remove_available_server(s)
+            if not was_available and self.standby_servers.pop(s.task_arn, None) is None:
+                continue # server was already removed
+            self.remove_server(s)
+
+        if len(self.terminate_queue) > 0:
+            self.terminate_pool.submit(self.flush_terminations)
+
+    def run(self):
+        """Main function which carries out routinely maintainance and updates in the backgorund"""
+
+        print("Starting server management thread")
+
+        if task_state_listener.queue_url:
+            task_state_listener.start()
+
+        while(True):
+            self.routine_update()
 
-                if s.ready_to_close:
-                    self.remove_server(s)
-                else:
-                    remaining_standby_servers.append(s)
-            
-            self.standby_servers = remaining_standby_servers
-            
             print("Ending server_update and sleeping")
-            sleep(self.thread_sleep_time) # Wait a little before the next update
-            # Unresponsive servers were given some time to recover
-            # If they don't respond to health checks even now, then remove them
-            for s in unresponsive_servers:
-                if not s.update_state():
-                    if s in self.available_servers:
-                        self.available_servers.remove(s)
-                    elif s in self.standby_servers:
-                        self.standby_servers.remove(s)                    
-                    self.remove_server(s)
+            self.wake_event.wait(self.thread_sleep_time) # Wait a little before the next update, unless woken up
+            self.wake_event.clear()
             
         return
@@ -1,3 +1,267 @@
-from django.test import TestCase
+import json
+from concurrent.futures import ThreadPoolExecutor
+from time import monotonic
+from unittest import mock
+from django.test import SimpleTestCase
 
-# Create your tests here.
+from . import aws_utils
+from .server_classes import Server, ServerManagerThread, TaskStateListener
+
+class IpCacheTest(SimpleTestCase):
+
+    def setUp(self):
+        aws_utils._ip_cache.clear()
+
+    def tearDown(self):
+        aws_utils._ip_cache.clear()
+
+    def describe_instances(self, InstanceIds: list) -> dict:
+        return {'Reservations': [{'Instances': [{'InstanceId': i, 'PublicIpAddress': '10.0.0.' + i[2:]} for i in InstanceIds]}]}
+
+    def test_ips_are_cached_up_to_ip_cache_size(self):
+        ec2_client = mock.Mock()
+        ec2_client.describe_instances.side_effect = self.describe_instances
+
+        with mock.patch.object(aws_utils, 'IP_CACHE_SIZE', 2):
+            self.assertEqual(aws_utils.get_ips(['i-1', 'i-2'], ec2_client), {'i-1': '10.0.0.1', 'i-2': '10.0.0.2'})
+            self.assertEqual(aws_utils.get_ip('i-1', ec2_client), '10.0.0.1') # cached, and now more recently used than i-2
+            self.assertEqual(aws_utils.get_ip('i-3', ec2_client), '10.0.0.3')
+
+        self.assertEqual(ec2_client.describe_instances.call_count, 2)
+        self.assertEqual(list(aws_utils._ip_cache), ['i-1', 'i-3'])
+
+        aws_utils.forget_ip('i-1')
+        self.assertEqual(list(aws_utils._ip_cache), ['i-3'])
+
+class TaskStateListenerTest(SimpleTestCase):
+
+    def setUp(self):
+        self.listener = TaskStateListener()
+        self.listener.queue_url = 'https://sqs.example/task-events'
+
+    def test_receive_events_skips_malformed_messages(self):
+        running_event = {'detail-type': 'ECS Task State Change', 'detail': {'taskArn': 'task-1', 'lastStatus': 'RUNNING'}}
+        sqs_client = mock.Mock()
+        sqs_client.receive_message.return_value = {'Messages': [
+            {'MessageId': 'bad', 'ReceiptHandle': 'bad-handle', 'Body': 'not json'},
+            {'MessageId': 'good', 'ReceiptHandle': 'good-handle', 'Body': json.dumps(running_event)},
+        ]}
+
+        with mock.patch('scaling_manager.server_classes.get_sqs_client', return_value=sqs_client):
+            self.listener.receive_events()
+
+        sqs_client.delete_message_batch.assert_called_once_with(
+            QueueUrl=self.listener.queue_url,
+            Entries=[{'Id': '0', 'ReceiptHandle': 'good-handle'}]
+        )
+        self.assertTrue(self.listener.running_events['task-1'].is_set())
+
+    def test_events_with_waiters_are_not_forgotten(self):
+        self.listener.MAX_UNCLAIMED_EVENTS = 2
+        awaited_event = self.listener._get_event('awaited-task') # as created by a wait_until_running caller
+
+        for i in range(5):
+            self.listener._get_event('task-' + str(i)).set() # RUNNING events which nobody is waiting on
+
+        self.assertIs(self.listener.running_events['awaited-task'], awaited_event)
+        self.assertEqual(len(self.listener.running_events), 2)
+
+def make_server(task_arn: str, available_capacity: int) -> Server:
+    return Server(task_arn=task_arn, ec2_id='i-' + task_arn, address='127.0.0.1:8888', available_capacity=available_capacity)
+
+class ServerManagerThreadTest(SimpleTestCase):
+
+    def setUp(self):
+        ServerManagerThread._ServerManagerThread__shared_instance = None
+        with mock.patch('scaling_manager.server_classes.get_tasks', return_value=[]), \
+                mock.patch('scaling_manager.server_classes.bulk_bootstrap_servers', return_value=[]):
+            self.manager = ServerManagerThread.get_instance()
+
+    def tearDown(self):
+        ServerManagerThread._ServerManagerThread__shared_instance = None
+
+    def add_servers(self, capacities: list) -> list:
+        servers = [make_server(str(i), capacity) for i, capacity in enumerate(capacities)]
+        with self.manager.servers_lock:
+            for server in servers:
+                self.manager.add_available_server(server)
+        self.manager.total_available_capacity = sum(capacities)
+        return servers
+
+    def test_get_available_server_picks_max_capacity(self):
+        servers = self.add_servers([3, 7, 5])
+
+        picked = [self.manager.get_available_server() for _ in range(4)]
+
+        self.assertEqual(picked, [servers[1], servers[1], servers[2], servers[1]]) # ties go to the older heap entry
+        self.assertEqual([s.available_capacity for s in servers], [3, 4, 4])
+        self.assertEqual(self.manager.total_available_capacity, 11)
+
+    def test_remove_available_server_is_lazily_deleted_from_heap(self):
+        servers = self.add_servers([3, 7, 5])
+        entry = self.manager.heap_entries[servers[1].task_arn]
+
+        with self.manager.servers_lock:
+            self.manager.remove_available_server(servers[1])
+
+        self.assertNotIn(servers[1].task_arn, self.manager.available_servers)
+        self.assertIsNone(entry[2])
+        self.assertIn(entry, self.manager.capacity_heap) # still in the heap till it reaches the top
+        self.assertIs(self.manager.get_max_available_server(), servers[2])
+        self.assertNotIn(entry, self.manager.capacity_heap)
+
+        # removing again is a no-op
+        with self.manager.servers_lock:
+            self.manager.remove_available_server(servers[1])
+        self.assertIs(self.manager.get_available_server(), servers[2])
+
+    def test_get_available_server_raises_when_full(self):
+        self.add_servers([0, 0])
+
+        with self.assertRaises(Exception):
+            self.manager.get_available_server()
+
+    def test_full_cluster_raises_without_rebuilding_heap(self):
+        self.add_servers([0, 0])
+
+        with mock.patch.object(self.manager, 'rebuild_capacity_heap') as rebuild_capacity_heap:
+            for _ in range(100):
+                with self.assertRaises(Exception):
+                    self.manager.get_available_server()
+            # the total isn't recomputed till the next routine update, so it may claim capacity which the servers don't have
+            self.manager.total_available_capacity = 5
+            for _ in range(100):
+                with self.assertRaises(Exception):
+                    self.manager.get_available_server()
+
+        rebuild_capacity_heap.assert_not_called()
+
+    def test_stale_heap_is_rebuilt_once_a_health_check_raises_capacity(self):
+        servers = self.add_servers([1, 0, 0])
+        self.assertIs(self.manager.get_available_server(), servers[0])
+
+        # a health check raises the capacity of a server whose entry isn't at the top of the heap
+        health_response = mock.Mock(content=b'{"ready_to_close": false, "available_capacity": 5}')
+        with mock.patch.object(Server._session, 'get', return_value=health_response):
+            self.assertTrue(servers[2].update_state(self.manager.mark_capacity_heap_stale))
+        self.assertTrue(self.manager.capacity_heap_stale)
+        self.manager.total_available_capacity = 5
+
+        self.assertIs(self.manager.get_available_server(), servers[2])
+        self.assertFalse(self.manager.capacity_heap_stale)
+        self.assertEqual(servers[2].available_capacity, 4)
+
+    def test_concurrent_assignments_never_exceed_capacity(self):
+        capacities = [50, 120, 80]
+        servers = self.add_servers(capacities)
+
+        def assign(_) -> bool:
+            try:
+                self.manager.get_available_server()
+                return True
+            except Exception:
+                return False
+
+        with ThreadPoolExecutor(max_workers=16) as pool:
+            results = list(pool.map(assign, range(400)))
+
+        self.assertEqual(sum(results), sum(capacities))
+        self.assertEqual([s.available_capacity for s in servers], [0, 0, 0])
+
+class RoutineUpdateTest(SimpleTestCase):
+
+    def setUp(self):
+        ServerManagerThread._ServerManagerThread__shared_instance = None
+        with mock.patch('scaling_manager.server_classes.get_tasks', return_value=[]), \
+                mock.patch('scaling_manager.server_classes.bulk_bootstrap_servers', return_value=[]):
+            self.manager = ServerManagerThread.get_instance()
+        self.manager.upscale_margin = 30
+        self.manager.downscale_margin = 100
+        self.manager.server_capacity = 10
+        self.manager.thread_sleep_time = 60
+        self.manager.startup_grace_time = 120
+        self.manager.launch_pool = ThreadPoolExecutor(max_workers=1)
+        self.launched_servers: list = []
+
+    def tearDown(self):
+        self.manager.launch_pool.shutdown()
+        ServerManagerThread._ServerManagerThread__shared_instance = None
+
+    def stub_add_server(self, launch_succeeds: bool = True):
+        """Patches add_server to register launched servers (like it does after launching them on AWS) or to fail"""
+        def add_server() -> bool:
+            if not launch_succeeds:
+                return False
+            server = make_server('launched-' + str(len(self.launched_servers)), 0)
+            with self.manager.pending_launches_lock:
+                self.manager.unchecked_servers.add(server.task_arn)
+            with self.manager.servers_lock:
+                self.manager.add_available_server(server)
+            self.launched_servers.append(server)
+            return True
+        return mock.patch.object(self.manager, 'add_server', side_effect=add_server)
+
+    def routine_update(self, health_checks_pass: bool) -> None:
+        """Runs one routine update and waits for the launches submitted by it"""
+        with mock.patch.object(Server, 'update_state', return_value=health_checks_pass):
+            self.manager.routine_update()
+        self.manager.launch_pool.submit(lambda: None).result() # launch_pool has a single worker, so earlier launches are done by now
+
+    def test_deficit_is_launched_once_till_launched_servers_are_checked(self):
+        with self.stub_add_server() as add_server:
+            self.routine_update(health_checks_pass=False)
+            self.assertEqual(add_server.call_count, 3)
+            self.assertEqual(self.manager.pending_launches, 3)
+
+            # the launched servers are still starting up, so their capacity isn't known yet
+            self.routine_update(health_checks_pass=False)
+            self.routine_update(health_checks_pass=False)
+            self.assertEqual(add_server.call_count, 3)
+            self.assertEqual(self.manager.pending_launches, 3)
+
+            # once checked, they are no longer pending; they report no capacity, so the deficit is launched again
+            self.routine_update(health_checks_pass=True)
+            self.assertEqual(add_server.call_count, 6)
+            self.assertEqual(self.manager.pending_launches, 3)
+            self.assertEqual(self.manager.unchecked_servers, {s.task_arn for s in self.launched_servers[3:]})
+
+    def test_failed_launch_is_no_longer_pending(self):
+        with self.stub_add_server(launch_succeeds=False) as add_server:
+            self.routine_update(health_checks_pass=False)
+            self.assertEqual(add_server.call_count, 3)
+            self.assertEqual(self.manager.pending_launches, 0)
+
+            self.routine_update(health_checks_pass=False)
+            self.assertEqual(add_server.call_count, 6)
+
+    def test_removed_unchecked_server_is_no_longer_pending(self):
+        with self.stub_add_server() as add_server:
+            self.routine_update(health_checks_pass=False)
+            with self.manager.servers_lock:
+                self.manager.remove_available_server(self.launched_servers[0])
+            self.assertEqual(self.manager.pending_launches, 2)
+
+            self.routine_update(health_checks_pass=False)
+            self.assertEqual(add_server.call_count, 4)
+            self.assertEqual(self.manager.pending_launches, 3)
+
+    def test_unchecked_server_is_given_startup_grace_time(self):
+        with self.stub_add_server():
+            self.routine_update(health_checks_pass=False)
+        starting_server, checked_server = self.launched_servers[:2]
+        self.manager.settle_launch(checked_server)
+
+        # both servers have failed health checks for longer than thread_sleep_time
+        for s in (starting_server, checked_server):
+            self.manager.unresponsive_since[s.task_arn] = monotonic() - 61
+        with self.stub_add_server(), mock.patch.object(self.manager, 'remove_server') as remove_server:
+            self.routine_update(health_checks_pass=False)
+        remove_server.assert_called_once_with(checked_server)
+        self.assertIn(starting_server.task_arn, self.manager.available_servers)
+
+        # the starting server is removed once it fails health checks for longer than startup_grace_time
+        self.manager.unresponsive_since[starting_server.task_arn] = monotonic() - 121
+        with self.stub_add_server(), mock.patch.object(self.manager, 'remove_server') as remove_server:
+            self.routine_update(health_checks_pass=False)
+        remove_server.assert_any_call(starting_server)
+        self.assertNotIn(starting_server.task_arn, self.manager.available_servers)